@@ -3,7 +3,8 @@
 Example config file:
 
 publisher_config:
-  # at least one of the following two needs to be provided. If both are present, expected_files will take precedence
+  # at least one of the following two needs to be provided. If both are present, output_files_log_regex will take
+  # precedence
   expected_files: /tmp/pytest-of-a001673/pytest-169/test_fake_publisher0/file?.bla
   output_files_log_regex: "Written output file : (.*.nc)"
   publisher_settings:
@@ -23,23 +24,34 @@ subscriber_config:
 
 """
 import argparse
+import copy
+import fnmatch
 import logging
 import logging.config
 import os
 import re
 from contextlib import closing, suppress
-from functools import partial
+from functools import lru_cache, partial
 from glob import glob
 from multiprocessing.pool import ThreadPool
 from subprocess import PIPE, Popen
+from threading import Event, Semaphore
 
 import yaml
 from posttroll.message import Message
 from posttroll.publisher import create_publisher_from_dict_config
 from posttroll.subscriber import create_subscriber_from_dict_config
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 logger = logging.getLogger("pytroll-runner")
 
+ACCEPTED_MESSAGE_TYPES = frozenset(("file", "dataset"))
+INPUT_FILE_KEYS = frozenset(("uri", "uid", "dataset"))
+
 
 def main(args=None):
     """Main script."""
@@ -54,7 +66,7 @@ def setup_logging(config_file):
     """Setup the logging from a log config yaml file."""
     if config_file is not None:
         with open(config_file) as fd:
-            log_dict = yaml.safe_load(fd.read())
+            log_dict = yaml.load(fd, Loader=_SafeLoader)
             logging.config.dictConfig(log_dict)
             return
 
@@ -92,8 +104,12 @@ def run_and_publish(config_file, message_file=None):
             except KeyError:
                 message = generate_message_from_expected_files(publisher_config, mda, preexisting_files)
                 preexisting_files = check_existing_files(publisher_config)
-            logger.debug(f"Sending message = {message}")
-            pub.send(str(message))
+            if message is None:
+                logger.warning("No output files found, not sending any message.")
+                continue
+            raw_message = str(message)
+            logger.debug("Sending message = %s", raw_message)
+            pub.send(raw_message)
 
 
 def run_from_message_file(command_to_call, message_file):
@@ -106,16 +122,46 @@ def run_from_message_file(command_to_call, message_file):
 def check_existing_files(publisher_config):
     """Check for previously generated files."""
     filepattern = publisher_config["expected_files"]
-    return set(glob(filepattern))
+    dirname, filename_regex, include_hidden = _split_file_pattern(filepattern)
+    if filename_regex is None:
+        return set(glob(filepattern))
+    try:
+        with os.scandir(dirname) as entries:
+            return {entry.path for entry in entries
+                    if (include_hidden or not entry.name.startswith("."))
+                    and filename_regex.match(os.path.normcase(entry.name))}
+    except OSError:
+        return set()
+
+
+@lru_cache
+def _split_file_pattern(filepattern):
+    """Split a glob pattern for scandir, with no filename regex if the directory is empty or has wildcards."""
+    dirname, basename = os.path.split(filepattern)
+    if not dirname or not basename or re.search("[*?[]", dirname):
+        return dirname, None, False
+    filename_regex = re.compile(fnmatch.translate(os.path.normcase(basename)))
+    return dirname, filename_regex, basename.startswith(".")
 
 
 def read_config(config_file):
     """Read the configuration file."""
-    with open(config_file) as fd:
-        config = yaml.safe_load(fd.read())
+    stat = os.stat(config_file)
+    # posttroll pops items from the settings it is given, so the cached config must not be handed out directly
+    config = copy.deepcopy(_load_config(os.fspath(config_file), stat.st_mtime_ns, stat.st_size))
     return validate_config(config)
 
 
+@lru_cache(maxsize=16)
+def _load_config(config_file, mtime_ns, size):
+    """Load the configuration file.
+
+    The modification time and size are only used as part of the cache key, so that an edited file gets reloaded.
+    """
+    with open(config_file) as fd:
+        return yaml.load(fd, Loader=_SafeLoader)
+
+
 def validate_config(config):
     """Validate the configuration file."""
     publisher_config = config["publisher_config"]
@@ -140,7 +186,11 @@ def run_from_new_subscriber(command, subscriber_settings):
 
 
 def run_on_messages(command, messages):
-    """Run the command on files from messages."""
+    """Run the command on files from messages.
+
+    No more messages than there are workers are handed to the pool at a time: the next message is only taken in when
+    the result of a previous one has been consumed. This keeps slow scripts from piling up pending messages.
+    """
     try:
         num_workers = command.get("workers", 1)
     except AttributeError:
@@ -148,25 +198,47 @@ def run_on_messages(command, messages):
     pool = ThreadPool(num_workers)
     run_command_on_message = partial(run_on_single_message, command)
 
-    yield from pool.imap_unordered(run_command_on_message, select_messages(messages))
+    free_workers = Semaphore(num_workers)
+    stopped = Event()
+    try:
+        for result in pool.imap_unordered(run_command_on_message,
+                                          wait_for_free_worker(select_messages(messages), free_workers, stopped)):
+            yield result
+            free_workers.release()
+    finally:
+        stopped.set()
+        free_workers.release()
+        # no join: the task handler may still be waiting for the next incoming message
+        pool.close()
+
+
+def wait_for_free_worker(messages, free_workers, stopped):
+    """Only take in the next message when a worker is free, and stop taking messages when the run is stopped."""
+    messages = iter(messages)
+    while True:
+        free_workers.acquire()
+        if stopped.is_set():
+            return
+        message = next(messages, None)
+        if message is None:
+            return
+        yield message
 
 
 def select_messages(messages):
     """Select only valid messages."""
-    accepted_message_types = ["file", "dataset"]
     for message in messages:
-        if message.type not in accepted_message_types:
+        if message.type not in ACCEPTED_MESSAGE_TYPES:
             continue
         yield message
 
 
 def run_on_single_message(command, message):
     """Run the command on files from message."""
-    try:  # file
+    if "uri" in message.data:  # file
         files = [message.data["uri"]]
-    except KeyError:  # dataset
-        files = []
-        files.extend(info["uri"] for info in message.data["dataset"])
+    else:  # dataset
+        files = [info["uri"] for info in message.data["dataset"]]
     return run_on_files(command, files), message.data
 
 
@@ -174,39 +246,58 @@ def run_on_files(command, files):
     """Run the command of files."""
     if not files:
         return
-    logger.info(f"Start running command {command} on files {files}")
+    logger.info("Start running command %s on files %s", command, files)
     try:
         command_to_call = command["command"]
     except TypeError:
         command_to_call = command
-    process = Popen([*os.fspath(command_to_call).split(), *files], stdout=PIPE)  # noqa: S603
+    process = Popen([*_split_command(command_to_call), *files], stdout=PIPE)  # noqa: S603
     out, _ = process.communicate()
-    logger.debug(f"After having run the script: {out}")
+    logger.debug("After having run the script: %s", out)
     return out
 
 
+@lru_cache
+def _split_command(command_to_call):
+    """Split the command to call into its arguments."""
+    return tuple(os.fspath(command_to_call).split())
+
+
 def generate_message_from_log_output(publisher_config, mda, log_output):
-    """Generate message for the filenames present in the log output."""
-    new_files = re.findall(publisher_config["output_files_log_regex"], str(log_output))
+    """Generate message for the filenames present in the log output.
+
+    The log output can be bytes, str or None. The regex is matched on the log output itself, so ``.`` does not match
+    line breaks and a match cannot span several log lines. Returns None when no output files are found.
+    """
+    regex = publisher_config["output_files_log_regex"]
+    new_files = []
+    if log_output:
+        pattern = _compile_log_regex(regex, not isinstance(log_output, str))
+        new_files = [os.fsdecode(filename) for filename in pattern.findall(log_output)]
     message = generate_message_from_new_files(publisher_config, new_files, mda)
     return message
 
 
+@lru_cache
+def _compile_log_regex(regex, as_bytes):
+    """Compile the regex used to find output files in the log output, as a bytes pattern if requested."""
+    return re.compile(regex.encode() if as_bytes else regex)
+
+
 def generate_message_from_expected_files(pub_config, extra_metadata=None, preexisting_files=None):
-    """Generate a message containing the expected files."""
+    """Generate a message containing the expected files, or None if no new files are found."""
     new_files = find_new_files(pub_config, preexisting_files or set())
 
     return generate_message_from_new_files(pub_config, new_files, extra_metadata)
 
 
 def generate_message_from_new_files(pub_config, new_files, extra_metadata):
-    """Generate a message containing the new files."""
+    """Generate a message containing the new files, or None if there are no new files."""
+    if not new_files:
+        return None
     metadata = populate_metadata(extra_metadata, pub_config.get("static_metadata", {}))
-    dataset = []
-    for filepath in sorted(new_files):
-        filename = os.path.basename(filepath)
-        dataset.append(dict(uid=filename, uri=filepath))
-    if len(new_files) == 1:
+    dataset = [dict(uid=os.path.basename(filepath), uri=filepath) for filepath in sorted(new_files)]
+    if len(dataset) == 1:
         metadata.update(dataset[0])
         message_type = "file"
     else:
@@ -224,9 +315,6 @@ def populate_metadata(extra_metadata, static_metadata):
     """Populate the metadata."""
     metadata = {}
     if extra_metadata is not None:
-        metadata.update(extra_metadata)
-        metadata.pop("uri", None)
-        metadata.pop("uid", None)
-        metadata.pop("dataset", None)
+        metadata = {key: value for key, value in extra_metadata.items() if key not in INPUT_FILE_KEYS}
     metadata.update(static_metadata)
     return metadata
@@ -1,6 +1,8 @@
 """Tests for the pytroll runner."""
 import logging
 import os
+import threading
+from multiprocessing.pool import ThreadPool
 from unittest import mock
 
 import pytest
@@ -9,7 +11,9 @@ from posttroll.message import Message
 from posttroll.testing import patched_publisher, patched_subscriber_recv
 
 from pytroll_runner import (
+    check_existing_files,
     generate_message_from_expected_files,
+    generate_message_from_log_output,
     main,
     read_config,
     run_and_publish,
@@ -18,6 +22,11 @@ from pytroll_runner import (
     run_on_messages,
 )
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 script = """#!/bin/bash
 echo "Got $*"
 """
@@ -60,30 +69,30 @@ root:
 """
 
 
-@pytest.fixture
-def log_config_file(tmp_path):
+@pytest.fixture(scope="module")
+def log_config_file(tmp_path_factory):
     """Write a log config file."""
-    log_config = tmp_path / "mylogconfig.yaml"
+    log_config = tmp_path_factory.mktemp("log_config") / "mylogconfig.yaml"
     with open(log_config, "w") as fobj:
         fobj.write(log_config_content)
 
     return log_config
 
 
-@pytest.fixture
-def command(tmp_path):
+@pytest.fixture(scope="module")
+def command(tmp_path_factory):
     """Make a command script that just prints out the files it got."""
-    command_file = tmp_path / "myscript.sh"
+    command_file = tmp_path_factory.mktemp("scripts") / "myscript.sh"
     with open(command_file, "w") as fobj:
         fobj.write(script)
     os.chmod(command_file, 0o700)
     return command_file
 
 
-@pytest.fixture
-def command_bla(tmp_path):
+@pytest.fixture(scope="module")
+def command_bla(tmp_path_factory):
     """Make a command script that adds ".bla" to the filename."""
-    command_file = tmp_path / "myscript_bla.sh"
+    command_file = tmp_path_factory.mktemp("scripts") / "myscript_bla.sh"
     with open(command_file, "w") as fobj:
         fobj.write(script_bla)
     os.chmod(command_file, 0o700)
@@ -111,10 +120,10 @@ def config_file_bla(tmp_path, config_bla):
     return write_config_file(tmp_path, config_bla)
 
 
-@pytest.fixture
-def command_aws(tmp_path):
+@pytest.fixture(scope="module")
+def command_aws(tmp_path_factory):
     """Make a command script that outputs a log with an output filename."""
-    command_file = tmp_path / "myscript_aws.sh"
+    command_file = tmp_path_factory.mktemp("scripts") / "myscript_aws.sh"
     with open(command_file, "w") as fobj:
         fobj.write(script_aws)
     os.chmod(command_file, 0o700)
@@ -146,7 +155,7 @@ def write_config_file(tmp_path, config):
     """Write a configturation file."""
     yaml_file = tmp_path / "config.yaml"
     with open(yaml_file, "w") as fd:
-        fd.write(yaml.dump(config))
+        yaml.dump(config, fd, Dumper=SafeDumper)
     return yaml_file
 
 
@@ -198,6 +207,59 @@ def test_run_on_messages_does_not_pass_dataset_from_ack(command):
         raise AssertionError
 
 
+def test_run_on_messages_takes_messages_as_workers_free_up(command):
+    """Test that a message is only taken in once the result of the previous one is consumed."""
+    some_files = ["file1", "file2", "file3"]
+    events = []
+
+    def messages():
+        for f in some_files:
+            events.append(("taken", f))
+            yield Message("some_topic", "file", data={"uri": f})
+
+    for out, _mda in run_on_messages(command, messages()):
+        events.append(("result", out.decode().split()[-1]))
+
+    assert events == [(event, f) for f in some_files for event in ("taken", "result")]
+
+
+def test_run_on_messages_is_not_blocked_by_an_idle_stream(command):
+    """Test that a stream waiting for messages does not hold up another stream."""
+    some_files = ["file1", "file2", "file3"]
+    more_messages = threading.Event()
+
+    def idle_messages():
+        more_messages.wait()
+        yield Message("some_topic", "file", data={"uri": "file0"})
+
+    messages = [Message("some_topic", "file", data={"uri": f}) for f in some_files]
+    pool = ThreadPool(2)
+    try:
+        idle_result = pool.apply_async(next, (run_on_messages(command, idle_messages()),))
+        results = pool.apply_async(list, (run_on_messages(command, messages),))
+        assert len(results.get(timeout=10)) == len(some_files)
+        more_messages.set()
+        out, _mda = idle_result.get(timeout=10)
+        assert out.decode().strip() == "Got file0"
+    finally:
+        more_messages.set()
+        pool.close()
+
+
+def test_run_on_messages_with_interleaved_streams(command):
+    """Test that two streams consumed in turn both finish."""
+    some_files = ["file1", "file2", "file3"]
+    first_messages = [Message("some_topic", "file", data={"uri": f}) for f in some_files]
+    second_messages = [Message("some_topic", "file", data={"uri": f}) for f in some_files]
+
+    streams = zip(run_on_messages(command, first_messages), run_on_messages(command, second_messages))
+    pool = ThreadPool(1)
+    try:
+        assert len(pool.apply_async(list, (streams,)).get(timeout=10)) == len(some_files)
+    finally:
+        pool.close()
+
+
 def test_run_starts_and_stops_subscriber(command):
     """Test that run starts and stops a subscriber."""
     subscriber_settings = dict(nameserver=False, addresses=["ipc://bla"])
@@ -224,8 +286,7 @@ def test_find_files_and_generate_message(tmp_path):
     """Test that multiple files generate a message with a dataset."""
     some_files = ["file1", "file2", "file3"]
     for filename in some_files:
-        with open(tmp_path / filename, "w") as fd:
-            fd.write("hi")
+        (tmp_path / filename).write_bytes(b"hi")
     pattern = os.fspath(tmp_path / "file?")
     pub_config = dict(publisher_settings=dict(nameserver=False, topic="/hi/there/"),
                       expected_files=pattern,
@@ -267,8 +328,7 @@ def files_to_glob(tmp_path):
     """Create multiple files to glob."""
     some_files = ["file1", "file2", "file3"]
     for filename in some_files:
-        with open(tmp_path / filename, "w") as fd:
-            fd.write("hi")
+        (tmp_path / filename).write_bytes(b"hi")
     pattern = os.fspath(tmp_path / "file?")
     return pattern
 
@@ -338,13 +398,39 @@ def test_dataset_removed_from_input_mda(single_file_to_glob):
     assert "dataset" not in message.data
 
 
+def test_check_existing_files_matches_glob(files_to_glob, tmp_path):
+    """Test that existing files are found like glob would, hidden files excluded."""
+    (tmp_path / ".file4").write_bytes(b"hi")
+    (tmp_path / "other1").write_bytes(b"hi")
+
+    existing_files = check_existing_files(dict(expected_files=files_to_glob))
+    assert existing_files == {os.fspath(tmp_path / f) for f in ["file1", "file2", "file3"]}
+
+
+def test_check_existing_files_with_wildcard_directory(tmp_path):
+    """Test that existing files are found when the directory contains wildcards."""
+    for dirname in ["dir1", "dir2"]:
+        (tmp_path / dirname).mkdir()
+        (tmp_path / dirname / "file1").write_bytes(b"hi")
+    pattern = os.fspath(tmp_path / "dir?" / "file?")
+
+    existing_files = check_existing_files(dict(expected_files=pattern))
+    assert existing_files == {os.fspath(tmp_path / d / "file1") for d in ["dir1", "dir2"]}
+
+
+def test_check_existing_files_in_missing_directory(tmp_path):
+    """Test that no files are found in a missing directory."""
+    pattern = os.fspath(tmp_path / "missing" / "file?")
+
+    assert check_existing_files(dict(expected_files=pattern)) == set()
+
+
 @pytest.fixture
 def single_file_to_glob(tmp_path):
     """Create a single file to glob."""
     some_files = ["file1"]
     for filename in some_files:
-        with open(tmp_path / filename, "w") as fd:
-            fd.write("hi")
+        (tmp_path / filename).write_bytes(b"hi")
     pattern = os.fspath(tmp_path / "file?")
     return pattern
 
@@ -354,8 +440,7 @@ def old_generated_file(tmp_path):
     """Create a single file to glob."""
     some_files = ["file0.bla"]
     for filename in some_files:
-        with open(tmp_path / filename, "w") as fd:
-            fd.write("hi")
+        (tmp_path / filename).write_bytes(b"hi")
     return filename
 
 
@@ -423,6 +508,55 @@ def test_run_and_publish_with_files_from_log(tmp_path, config_file_aws):
             assert message.data["uri"] == "/local_disk/aws_test/test/RAD_AWS_1B/" + expected
 
 
+def test_generate_message_from_log_output_finds_files_on_separate_lines():
+    """Test that the output files are found line by line in the log output."""
+    pub_config = dict(topic="/hi/there",
+                      output_files_log_regex="Written output file : (.*.nc)")
+    log_output = b"Written output file : /data/file1.nc\nWritten output file : /data/file2.nc\n"
+
+    message = generate_message_from_log_output(pub_config, None, log_output)
+    assert [ds["uri"] for ds in message.data["dataset"]] == ["/data/file1.nc", "/data/file2.nc"]
+
+
+def test_generate_message_from_log_output_accepts_str():
+    """Test that the log output can also be given as a string."""
+    pub_config = dict(topic="/hi/there",
+                      output_files_log_regex="Written output file : (.*.nc)")
+    log_output = "Written output file : /data/file1.nc\n"
+
+    message = generate_message_from_log_output(pub_config, None, log_output)
+    assert message.data["uri"] == "/data/file1.nc"
+
+
+def test_run_and_no_publish_when_regex_unmatched(tmp_path, config_aws, caplog):
+    """Test that no message is published when no output files are found in the log."""
+    config_aws["publisher_config"]["output_files_log_regex"] = "Written output file : (.*.bla)"
+    yaml_file = write_config_file(tmp_path, config_aws)
+
+    some_files = ["file1"]
+    data = {"dataset": [{"uri": os.fspath(tmp_path / f), "uid": f} for f in some_files]}
+    first_message = Message("some_topic", "dataset", data=data)
+
+    with patched_subscriber_recv([first_message]):
+        with patched_publisher() as published_messages:
+            run_and_publish(yaml_file)
+            assert len(published_messages) == 0
+    assert "No output files found" in caplog.text
+
+
+def test_run_and_no_publish_when_no_new_expected_files(tmp_path, config_file_bla, caplog):
+    """Test that no message is published when no new expected files appear."""
+    some_files = ["missing_file1"]
+    data = {"dataset": [{"uri": os.fspath(tmp_path / f), "uid": f} for f in some_files]}
+    first_message = Message("some_topic", "dataset", data=data)
+
+    with patched_subscriber_recv([first_message]):
+        with patched_publisher() as published_messages:
+            run_and_publish(config_file_bla)
+            assert len(published_messages) == 0
+    assert "No output files found" in caplog.text
+
+
 def test_run_and_publish_with_faulty_config(tmp_path, config_aws):
     """Test run and publish."""
     config_aws["publisher_config"].pop("output_files_log_regex")
@@ -448,9 +582,7 @@ def test_config_reader(command, tmp_path):
     test_config = dict(subscriber_config=sub_config,
                        script=command_path,
                        publisher_config=pub_config)
-    yaml_file = tmp_path / "config.yaml"
-    with open(yaml_file, "w") as fd:
-        fd.write(yaml.dump(test_config))
+    yaml_file = write_config_file(tmp_path, test_config)
     command_to_call, subscriber_config, publisher_config = read_config(yaml_file)
 
     assert subscriber_config == sub_config
@@ -458,6 +590,18 @@ def test_config_reader(command, tmp_path):
     assert publisher_config == pub_config
 
 
+def test_config_reader_reloads_modified_config(tmp_path, config_bla):
+    """Test that the config reader picks up changes to the config file."""
+    yaml_file = write_config_file(tmp_path, config_bla)
+    command_to_call, _, _ = read_config(yaml_file)
+    assert command_to_call == config_bla["script"]
+
+    config_bla["script"] = "/bin/true"
+    write_config_file(tmp_path, config_bla)
+    command_to_call, _, _ = read_config(yaml_file)
+    assert command_to_call == "/bin/true"
+
+
 def test_main_crashes_when_config_missing():
     """Test that main crashes when config is missing."""
     with pytest.raises(SystemExit):
@@ -485,8 +629,7 @@ def ten_files_to_glob(tmp_path):
     n_files = 10
     some_files = [f"file{n}" for n in range(n_files)]
     for filename in some_files:
-        with open(tmp_path / filename, "w") as fd:
-            fd.write("hi")
+        (tmp_path / filename).write_bytes(b"hi")
     return some_files
 
 def test_run_and_publish_with_command_subitem_and_thread_number(tmp_path, command_bla, ten_files_to_glob):
@@ -499,9 +642,7 @@ def test_run_and_publish_with_command_subitem_and_thread_number(tmp_path, comman
     test_config = dict(subscriber_config=sub_config,
                        script=dict(command=command_path, workers=4),
                        publisher_config=pub_config)
-    yaml_file = tmp_path / "config.yaml"
-    with open(yaml_file, "w") as fd:
-        fd.write(yaml.dump(test_config))
+    yaml_file = write_config_file(tmp_path, test_config)
 
     some_files = ten_files_to_glob
     datas = [{"uri": os.fspath(tmp_path / f), "uid": f}  for f in some_files]